@@ -49,6 +49,7 @@ import traceback
 import inspect
 import warnings
 import multiprocessing
+import threading
 import copy
 import numpy as np
 from collections.abc import Iterable
@@ -1642,24 +1643,24 @@ def general_startup(override_args=None):
 #==================================================================# 
 
 def tpumtjgetsofttokens():
-    soft_tokens = None
+    params = tpu_mtj_backend.params
+    d_embed = params.get("d_embed", params["d_model"])
     if(koboldai_vars.sp is None):
-        tensor = np.zeros((1, tpu_mtj_backend.params.get("d_embed", tpu_mtj_backend.params["d_model"])), dtype=np.float32)
-        rows = tensor.shape[0]
-        padding_amount = tpu_mtj_backend.params["seq"] - (tpu_mtj_backend.params["seq"] % -tpu_mtj_backend.params["cores_per_replica"]) - rows
-        tensor = np.pad(tensor, ((0, padding_amount), (0, 0)))
-        tensor = tensor.reshape(
-            tpu_mtj_backend.params["cores_per_replica"],
-            -1,
-            tpu_mtj_backend.params.get("d_embed", tpu_mtj_backend.params["d_model"]),
-        )
+        # An empty soft prompt is all zeros, so allocate it already padded to a multiple of cores_per_replica rows
+        padded_rows = params["seq"] - (params["seq"] % -params["cores_per_replica"])
+        tensor = np.zeros((params["cores_per_replica"], padded_rows // params["cores_per_replica"], d_embed), dtype=np.float32)
         koboldai_vars.sp = tpu_mtj_backend.shard_xmap(tensor)
-    soft_tokens = np.arange(
-        tpu_mtj_backend.params["n_vocab"] + tpu_mtj_backend.params["n_vocab_padding"],
-        tpu_mtj_backend.params["n_vocab"] + tpu_mtj_backend.params["n_vocab_padding"] + koboldai_vars.sp_length,
-        dtype=np.uint32
-    )
-    return soft_tokens
+    key = (params["n_vocab"], params["n_vocab_padding"], koboldai_vars.sp_length)
+    if(tpumtjgetsofttokens.cache[0] != key):
+        soft_tokens = np.arange(
+            params["n_vocab"] + params["n_vocab_padding"],
+            params["n_vocab"] + params["n_vocab_padding"] + koboldai_vars.sp_length,
+            dtype=np.uint32
+        )
+        soft_tokens.flags.writeable = False
+        tpumtjgetsofttokens.cache = (key, soft_tokens)
+    return tpumtjgetsofttokens.cache[1]
+tpumtjgetsofttokens.cache = (None, None)
 
 @socketio.on("get_model_info")
 def get_model_info(model, directory=""):
@@ -2046,10 +2047,12 @@ def patch_transformers():
         utils.current_shard = 0
         utils.from_pretrained_model_name = pretrained_model_name_or_path
         utils.from_pretrained_index_filename = None
+        utils.checkpoint_shard_files = None
         utils.from_pretrained_kwargs = kwargs
         utils.bar = None
         if not args.no_aria2:
             utils.aria2_hook(pretrained_model_name_or_path, **kwargs)
+        utils.parallel_download_hook(pretrained_model_name_or_path, **kwargs)
         return old_from_pretrained(cls, pretrained_model_name_or_path, *model_args, **kwargs)
     if(not hasattr(PreTrainedModel, "_kai_patched")):
         PreTrainedModel.from_pretrained = new_from_pretrained
@@ -2059,8 +2062,16 @@ def patch_transformers():
         def new_get_checkpoint_shard_files(pretrained_model_name_or_path, index_filename, *args, **kwargs):
             utils.num_shards = utils.get_num_shards(index_filename)
             utils.from_pretrained_index_filename = index_filename
-            return old_get_checkpoint_shard_files(pretrained_model_name_or_path, index_filename, *args, **kwargs)
+            shard_files, sharded_metadata = old_get_checkpoint_shard_files(pretrained_model_name_or_path, index_filename, *args, **kwargs)
+            utils.checkpoint_shard_files = list(shard_files)
+            return shard_files, sharded_metadata
         modeling_utils.get_checkpoint_shard_files = new_get_checkpoint_shard_files
+    if(hasattr(modeling_utils, "load_state_dict")):
+        old_load_state_dict = modeling_utils.load_state_dict
+        def new_load_state_dict(checkpoint_file, *args, **kwargs):
+            utils.prefetch_next_checkpoint_shard(checkpoint_file)
+            return old_load_state_dict(checkpoint_file, *args, **kwargs)
+        modeling_utils.load_state_dict = new_load_state_dict
         
     # Some versions of transformers 4.17.0.dev0 are affected by
     # https://github.com/huggingface/transformers/issues/15736
@@ -2626,9 +2637,43 @@ def unload_model():
         pass
         
     #Reload our badwords
+    wait_for_badwordsids()
     koboldai_vars.badwordsids = koboldai_settings.badwordsids_default
     
     
+#==================================================================#
+#  Scanning the tokenizer's vocabulary for tokens to ban is slow for
+#  large vocabularies, so it runs in the background while the rest of
+#  the model is loaded
+#==================================================================#
+badwordsids_thread: Optional[threading.Thread] = None
+badwordsids_error: Optional[BaseException] = None
+
+def start_badwordsids_scan(tokenizer, bad_chars: str, ban_eos: bool = True) -> None:
+    global badwordsids_thread
+    wait_for_badwordsids()
+    pattern = re.compile("[" + re.escape(bad_chars) + "]")
+    vocab = tokenizer.get_vocab()
+    def scan():
+        global badwordsids_error
+        try:
+            koboldai_vars.badwordsids = [[v] for k, v in ((str(k), v) for k, v in vocab.items()) if pattern.search(k) and (ban_eos or k != "</s>")]
+        except BaseException as e:
+            badwordsids_error = e
+    badwordsids_thread = threading.Thread(target=scan, daemon=True)
+    badwordsids_thread.start()
+
+def wait_for_badwordsids() -> None:
+    global badwordsids_thread, badwordsids_error
+    if badwordsids_thread is not None:
+        badwordsids_thread.join()
+        badwordsids_thread = None
+    if badwordsids_error is not None:
+        # Raise errors from the scan here so that loading fails like it did when the scan ran inline
+        e, badwordsids_error = badwordsids_error, None
+        raise e
+
+
 def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=False, online_model="", use_breakmodel_args=False, breakmodel_args_default_to_cpu=False, url=None, use_8_bit=False):
     global model
     global generator
@@ -3013,6 +3058,15 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
                 else:
                     yield False
 
+            def to_cpu_float32(model: PreTrainedModel) -> PreTrainedModel:
+                # Only traverse the model again if something actually needs to be moved or converted
+                tensors = lambda: itertools.chain(model.parameters(), model.buffers())
+                if(any(t.device.type != "cpu" for t in tensors())):
+                    model = model.to("cpu")
+                if(any(t.is_floating_point() and t.dtype is not torch.float32 for t in tensors())):
+                    model = model.float()
+                return model
+
             # If custom GPT2 model was chosen
             if(koboldai_vars.model_type == "gpt2"):
                 koboldai_vars.lazy_load = False
@@ -3046,7 +3100,7 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
                     model = model.half().to(koboldai_vars.gpu_device)
                     generator = model.generate
                 else:
-                    model = model.to('cpu').float()
+                    model = to_cpu_float32(model)
                     generator = model.generate
                 patch_causallm(model)
             # Use the Generic implementation
@@ -3067,21 +3121,28 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
                 # Download model from Huggingface if it does not exist, otherwise load locally
                 
                 #If we specify a model and it's in the root directory, we need to move it to the models directory (legacy folder structure to new)
-                if os.path.isdir(koboldai_vars.model.replace('/', '_')):
+                legacy_model_path = koboldai_vars.model.replace('/', '_')
+                local_model_path = "models/{}".format(legacy_model_path)
+                if os.path.isdir(legacy_model_path):
                     import shutil
-                    shutil.move(koboldai_vars.model.replace('/', '_'), "models/{}".format(koboldai_vars.model.replace('/', '_')))
+                    shutil.move(legacy_model_path, local_model_path)
                 if(koboldai_vars.lazy_load):  # If we're using lazy loader, we need to figure out what the model's hidden layers are called
                     with torch_lazy_loader.use_lazy_torch_load(dematerialized_modules=True, use_accelerate_init_empty_weights=True):
-                        try:
-                            metamodel = AutoModelForCausalLM.from_config(model_config)
-                        except Exception as e:
+                        from transformers.models.auto.modeling_auto import MODEL_FOR_CAUSAL_LM_MAPPING_NAMES
+                        if(getattr(model_config, "model_type", None) in MODEL_FOR_CAUSAL_LM_MAPPING_NAMES):
+                            try:
+                                metamodel = AutoModelForCausalLM.from_config(model_config)
+                            except Exception as e:
+                                metamodel = GPTNeoForCausalLM.from_config(model_config)
+                        else:  # AutoModelForCausalLM would just raise for model types it doesn't know, so don't bother building it
                             metamodel = GPTNeoForCausalLM.from_config(model_config)
                         utils.layers_module_names = utils.get_layers_module_names(metamodel)
-                        utils.module_names = list(metamodel.state_dict().keys())
-                        utils.named_buffers = list(metamodel.named_buffers(recurse=True))
+                        utils.module_names, utils.named_buffers = utils.get_state_dict_names_and_buffers(metamodel)
                 with maybe_use_float16(), torch_lazy_loader.use_lazy_torch_load(enable=koboldai_vars.lazy_load, callback=get_lazy_load_callback(utils.num_layers(model_config)) if koboldai_vars.lazy_load else None, dematerialized_modules=True):
                     if(koboldai_vars.lazy_load):  # torch_lazy_loader.py and low_cpu_mem_usage can't be used at the same time
                         lowmem = {}
+                    if(koboldai_vars.hascuda and koboldai_vars.usegpu):  # The model is going to be converted to float16 for the GPU anyway, so load it that way
+                        lowmem["torch_dtype"] = torch.float16
                     if(os.path.isdir(koboldai_vars.custmodpth)):
                         try:
                             tokenizer = AutoTokenizer.from_pretrained(koboldai_vars.custmodpth, revision=koboldai_vars.revision, cache_dir="cache", use_fast=False)
@@ -3099,37 +3160,24 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
                             if("out of memory" in traceback.format_exc().lower()):
                                 raise RuntimeError("One of your GPUs ran out of memory when KoboldAI tried to load your model.")
                             model     = GPTNeoForCausalLM.from_pretrained(koboldai_vars.custmodpth, revision=koboldai_vars.revision, cache_dir="cache", **lowmem)
-                    elif(os.path.isdir("models/{}".format(koboldai_vars.model.replace('/', '_')))):
+                    elif(os.path.isdir(local_model_path)):
                         try:
-                            tokenizer = AutoTokenizer.from_pretrained("models/{}".format(koboldai_vars.model.replace('/', '_')), revision=koboldai_vars.revision, cache_dir="cache", use_fast=False)
+                            tokenizer = AutoTokenizer.from_pretrained(local_model_path, revision=koboldai_vars.revision, cache_dir="cache", use_fast=False)
                         except Exception as e:
                             try:
-                                tokenizer = AutoTokenizer.from_pretrained("models/{}".format(koboldai_vars.model.replace('/', '_')), revision=koboldai_vars.revision, cache_dir="cache")
+                                tokenizer = AutoTokenizer.from_pretrained(local_model_path, revision=koboldai_vars.revision, cache_dir="cache")
                             except Exception as e:
                                 try:
-                                    tokenizer = GPT2Tokenizer.from_pretrained("models/{}".format(koboldai_vars.model.replace('/', '_')), revision=koboldai_vars.revision, cache_dir="cache")
+                                    tokenizer = GPT2Tokenizer.from_pretrained(local_model_path, revision=koboldai_vars.revision, cache_dir="cache")
                                 except Exception as e:
                                     tokenizer = GPT2Tokenizer.from_pretrained("gpt2", revision=koboldai_vars.revision, cache_dir="cache")
                         try:
-                            model     = AutoModelForCausalLM.from_pretrained("models/{}".format(koboldai_vars.model.replace('/', '_')), revision=koboldai_vars.revision, cache_dir="cache", **lowmem)
+                            model     = AutoModelForCausalLM.from_pretrained(local_model_path, revision=koboldai_vars.revision, cache_dir="cache", **lowmem)
                         except Exception as e:
                             if("out of memory" in traceback.format_exc().lower()):
                                 raise RuntimeError("One of your GPUs ran out of memory when KoboldAI tried to load your model.")
-                            model     = GPTNeoForCausalLM.from_pretrained("models/{}".format(koboldai_vars.model.replace('/', '_')), revision=koboldai_vars.revision, cache_dir="cache", **lowmem)
+                            model     = GPTNeoForCausalLM.from_pretrained(local_model_path, revision=koboldai_vars.revision, cache_dir="cache", **lowmem)
                     else:
-                        old_rebuild_tensor = torch._utils._rebuild_tensor
-                        def new_rebuild_tensor(storage: Union[torch_lazy_loader.LazyTensor, torch.Storage], storage_offset, shape, stride):
-                            if(not isinstance(storage, torch_lazy_loader.LazyTensor)):
-                                dtype = storage.dtype
-                            else:
-                                dtype = storage.storage_type.dtype
-                                if(not isinstance(dtype, torch.dtype)):
-                                    dtype = storage.storage_type(0).dtype
-                            if(dtype is torch.float32 and len(shape) >= 2):
-                                koboldai_vars.fp32_model = True
-                            return old_rebuild_tensor(storage, storage_offset, shape, stride)
-                        torch._utils._rebuild_tensor = new_rebuild_tensor
-
                         try:
                             tokenizer = AutoTokenizer.from_pretrained(koboldai_vars.model, revision=koboldai_vars.revision, cache_dir="cache", use_fast=False)
                         except Exception as e:
@@ -3147,67 +3195,69 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
                                 raise RuntimeError("One of your GPUs ran out of memory when KoboldAI tried to load your model.")
                             model     = GPTNeoForCausalLM.from_pretrained(koboldai_vars.model, revision=koboldai_vars.revision, cache_dir="cache", **lowmem)
 
-                        torch._utils._rebuild_tensor = old_rebuild_tensor
-
                         if not (args.colab or args.cacheonly) or args.savemodel:
                             import shutil
-                            tokenizer.save_pretrained("models/{}".format(koboldai_vars.model.replace('/', '_')))
+                            import huggingface_hub
+                            import transformers.modeling_utils
+                            legacy = packaging.version.parse(transformers_version) < packaging.version.parse("4.22.0.dev0")
+                            if(not koboldai_vars.lazy_load):  # The lazy loader callback already flags fp32 checkpoints while loading; otherwise read the dtypes from the checkpoint files' metadata
+                                if(utils.checkpoint_shard_files is not None):
+                                    checkpoint_files = utils.checkpoint_shard_files
+                                else:
+                                    try:
+                                        checkpoint_files = utils.get_cached_file_paths(koboldai_vars.model, [transformers.modeling_utils.WEIGHTS_NAME], revision=koboldai_vars.revision, cache_dir="cache", legacy_cache_layout=legacy)
+                                    except:
+                                        checkpoint_files = utils.get_cached_file_paths(koboldai_vars.model, ["model.safetensors"], revision=koboldai_vars.revision, cache_dir="cache", legacy_cache_layout=legacy)
+                                koboldai_vars.fp32_model = utils.checkpoint_has_fp32_tensors(checkpoint_files)
+                            tokenizer.save_pretrained(local_model_path)
                             if(koboldai_vars.fp32_model and ("breakmodel" not in globals() or not breakmodel.disk_blocks)):  # Use save_pretrained to convert fp32 models to fp16, unless we are using disk cache because save_pretrained is not supported in that case
                                 model = model.half()
-                                model.save_pretrained("models/{}".format(koboldai_vars.model.replace('/', '_')), max_shard_size="500MiB")
+                                model.save_pretrained(local_model_path, max_shard_size="500MiB")
                             else:  # For fp16 models, we can just copy the model files directly
                                 import transformers.configuration_utils
                                 import transformers.modeling_utils
                                 import transformers.file_utils
-                                import huggingface_hub
-                                legacy = packaging.version.parse(transformers_version) < packaging.version.parse("4.22.0.dev0")
-                                # Save the config.json
-                                shutil.move(os.path.realpath(huggingface_hub.hf_hub_download(koboldai_vars.model, transformers.configuration_utils.CONFIG_NAME, revision=koboldai_vars.revision, cache_dir="cache", local_files_only=True, legacy_cache_layout=legacy)), os.path.join("models/{}".format(koboldai_vars.model.replace('/', '_')), transformers.configuration_utils.CONFIG_NAME))
+                                def move_cached_files(filenames):
+                                    paths = utils.get_cached_file_paths(koboldai_vars.model, filenames, revision=koboldai_vars.revision, cache_dir="cache", legacy_cache_layout=legacy)
+                                    utils.move_files([(os.path.realpath(path), os.path.join(local_model_path, filename)) for filename, path in zip(filenames, paths)])
                                 if(utils.num_shards is None):
-                                    # Save the pytorch_model.bin of an unsharded model
+                                    # Save the config.json and the pytorch_model.bin of an unsharded model
                                     try:
-                                        shutil.move(os.path.realpath(huggingface_hub.hf_hub_download(koboldai_vars.model, transformers.modeling_utils.WEIGHTS_NAME, revision=koboldai_vars.revision, cache_dir="cache", local_files_only=True, legacy_cache_layout=legacy)), os.path.join("models/{}".format(koboldai_vars.model.replace('/', '_')), transformers.modeling_utils.WEIGHTS_NAME))
+                                        move_cached_files([transformers.configuration_utils.CONFIG_NAME, transformers.modeling_utils.WEIGHTS_NAME])
                                     except:
-                                        shutil.move(os.path.realpath(huggingface_hub.hf_hub_download(koboldai_vars.model,  "model.safetensors", revision=koboldai_vars.revision, cache_dir="cache", local_files_only=True, legacy_cache_layout=legacy)), os.path.join("models/{}".format(koboldai_vars.model.replace('/', '_')), "model.safetensors"))
+                                        move_cached_files([transformers.configuration_utils.CONFIG_NAME, "model.safetensors"])
                                 else:
                                     with open(utils.from_pretrained_index_filename) as f:
                                         map_data = json.load(f)
                                     filenames = set(map_data["weight_map"].values())
                                     # Save the pytorch_model.bin.index.json of a sharded model
-                                    shutil.move(os.path.realpath(utils.from_pretrained_index_filename), os.path.join("models/{}".format(koboldai_vars.model.replace('/', '_')), transformers.modeling_utils.WEIGHTS_INDEX_NAME))
-                                    # Then save the pytorch_model-#####-of-#####.bin files
-                                    for filename in filenames:
-                                        shutil.move(os.path.realpath(huggingface_hub.hf_hub_download(koboldai_vars.model, filename, revision=koboldai_vars.revision, cache_dir="cache", local_files_only=True, legacy_cache_layout=legacy)), os.path.join("models/{}".format(koboldai_vars.model.replace('/', '_')), filename))
-                            shutil.rmtree("cache/")
+                                    utils.move_file(os.path.realpath(utils.from_pretrained_index_filename), os.path.join(local_model_path, transformers.modeling_utils.WEIGHTS_INDEX_NAME))
+                                    # Then save the config.json and the pytorch_model-#####-of-#####.bin files
+                                    move_cached_files([transformers.configuration_utils.CONFIG_NAME, *filenames])
+                            if(legacy):  # The legacy cache layout doesn't keep each model in its own folder
+                                shutil.rmtree("cache/")
+                            else:  # Only remove what was downloaded for this model and leave the rest of the cache alone
+                                shutil.rmtree(os.path.join("cache", huggingface_hub.file_download.repo_folder_name(repo_id=koboldai_vars.model, repo_type="model")), ignore_errors=True)
 
                 if(koboldai_vars.badwordsids is koboldai_settings.badwordsids_default and koboldai_vars.model_type not in ("gpt2", "gpt_neo", "gptj")):
-                    koboldai_vars.badwordsids = [[v] for k, v in tokenizer.get_vocab().items() if any(c in str(k) for c in "[]")]
+                    start_badwordsids_scan(tokenizer, "[]")
                 patch_causallm(model)
 
-                if(koboldai_vars.hascuda):
-                    if(koboldai_vars.usegpu):
-                        koboldai_vars.modeldim = get_hidden_size_from_model(model)
-                        model = model.half().to(koboldai_vars.gpu_device)
-                        generator = model.generate
-                    elif(koboldai_vars.breakmodel):  # Use both RAM and VRAM (breakmodel)
-                        koboldai_vars.modeldim = get_hidden_size_from_model(model)
-                        if(not koboldai_vars.lazy_load):
-                            device_config(model.config)
-                        move_model_to_devices(model)
-                    elif(utils.HAS_ACCELERATE and __import__("breakmodel").disk_blocks > 0):
-                        move_model_to_devices(model)
-                        koboldai_vars.modeldim = get_hidden_size_from_model(model)
-                        generator = model.generate
-                    else:
-                        model = model.to('cpu').float()
-                        koboldai_vars.modeldim = get_hidden_size_from_model(model)
-                        generator = model.generate
+                if(koboldai_vars.hascuda and koboldai_vars.usegpu):
+                    koboldai_vars.modeldim = get_hidden_size_from_model(model)
+                    model = model.to(koboldai_vars.gpu_device, dtype=torch.float16)
+                    generator = model.generate
+                elif(koboldai_vars.hascuda and koboldai_vars.breakmodel):  # Use both RAM and VRAM (breakmodel)
+                    koboldai_vars.modeldim = get_hidden_size_from_model(model)
+                    if(not koboldai_vars.lazy_load):
+                        device_config(model.config)
+                    move_model_to_devices(model)
                 elif(utils.HAS_ACCELERATE and __import__("breakmodel").disk_blocks > 0):
                     move_model_to_devices(model)
                     koboldai_vars.modeldim = get_hidden_size_from_model(model)
                     generator = model.generate
                 else:
-                    model.to('cpu').float()
+                    model = to_cpu_float32(model)
                     koboldai_vars.modeldim = get_hidden_size_from_model(model)
                     generator = model.generate
             
@@ -3234,10 +3284,12 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
             utils.current_shard = 0
             utils.from_pretrained_model_name = pretrained_model_name_or_path
             utils.from_pretrained_index_filename = None
+            utils.checkpoint_shard_files = None
             utils.from_pretrained_kwargs = kwargs
             utils.bar = None
             if not args.no_aria2:
                 utils.aria2_hook(pretrained_model_name_or_path, **kwargs)
+            utils.parallel_download_hook(pretrained_model_name_or_path, **kwargs)
             return old_from_pretrained(cls, pretrained_model_name_or_path, *model_args, **kwargs)
         if(not hasattr(PreTrainedModel, "_kai_patched")):
             PreTrainedModel.from_pretrained = new_from_pretrained
@@ -3247,25 +3299,28 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
             def new_get_checkpoint_shard_files(pretrained_model_name_or_path, index_filename, *args, **kwargs):
                 utils.num_shards = utils.get_num_shards(index_filename)
                 utils.from_pretrained_index_filename = index_filename
-                return old_get_checkpoint_shard_files(pretrained_model_name_or_path, index_filename, *args, **kwargs)
+                shard_files, sharded_metadata = old_get_checkpoint_shard_files(pretrained_model_name_or_path, index_filename, *args, **kwargs)
+                utils.checkpoint_shard_files = list(shard_files)
+                return shard_files, sharded_metadata
             modeling_utils.get_checkpoint_shard_files = new_get_checkpoint_shard_files
 
 
         def tpumtjgenerate_warper_callback(scores) -> "np.array":
             scores_shape = scores.shape
-            scores_list = scores.tolist()
-            koboldai_vars.lua_koboldbridge.logits = koboldai_vars.lua_state.table()
-            for r, row in enumerate(scores_list):
-                koboldai_vars.lua_koboldbridge.logits[r+1] = koboldai_vars.lua_state.table(*row)
-            koboldai_vars.lua_koboldbridge.vocab_size = scores_shape[-1]
+            bridge = koboldai_vars.lua_koboldbridge
+            table_from = koboldai_vars.lua_state.table_from
+            bridge.logits = table_from([table_from(row) for row in scores.tolist()])
+            bridge.vocab_size = scores_shape[-1]
 
             execute_genmod()
 
-            scores = np.array(
-                tuple(tuple(row.values()) for row in koboldai_vars.lua_koboldbridge.logits.values()),
-                dtype=scores.dtype,
-            )
-            assert scores.shape == scores_shape
+            rows = tuple(bridge.logits.values())
+            assert len(rows) == scores_shape[0]
+            scores = np.empty(scores_shape, dtype=scores.dtype)
+            for r, row in enumerate(rows):
+                values = tuple(row.values())
+                assert len(values) == scores_shape[1]
+                scores[r] = values
 
             return scores
         
@@ -3277,23 +3332,64 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
             halt = koboldai_vars.abort or not koboldai_vars.lua_koboldbridge.generating or koboldai_vars.generated_tkns >= koboldai_vars.genamt
             koboldai_vars.lua_koboldbridge.regeneration_required = False
 
-            global past
+            # The decode caches only describe the current call to generate_dynamic
+            if(n_generated == 1):
+                tpumtjgenerate_stopping_callback.decoded_prompt.clear()
+                tpumtjgenerate_stopping_callback.decoded_generated.clear()
 
+            seq = tpu_mtj_backend.params["seq"]
+            generated_tkns = koboldai_vars.generated_tkns
+            lua_generated = koboldai_vars.lua_koboldbridge.generated
+            col = seq + n_generated - 1
             for i in range(koboldai_vars.numseqs):
-                koboldai_vars.lua_koboldbridge.generated[i+1][koboldai_vars.generated_tkns] = int(generated[i, tpu_mtj_backend.params["seq"] + n_generated - 1].item())
+                lua_generated[i+1][generated_tkns] = int(generated[i, col].item())
 
             if(not koboldai_vars.dynamicscan or halt):
+                tpumtjgenerate_stopping_callback.decoded_prompt.clear()
+                tpumtjgenerate_stopping_callback.decoded_generated.clear()
                 return excluded_world_info, regeneration_required, halt
 
             for i, t in enumerate(generated):
-                decoded = utils.decodenewlines(tokenizer.decode(past[i])) + utils.decodenewlines(tokenizer.decode(t[tpu_mtj_backend.params["seq"] : tpu_mtj_backend.params["seq"] + n_generated]))
+                if(i not in tpumtjgenerate_stopping_callback.decoded_prompt):
+                    # The first seq tokens of each sequence are the prompt, left-padded and prefixed with the soft prompt's tokens
+                    prompt = t[:seq]
+                    not_padding = np.flatnonzero(prompt != tpu_mtj_backend.pad_token_id)
+                    prompt = prompt[not_padding[0] if len(not_padding) else seq:]
+                    prompt = prompt[prompt < tpu_mtj_backend.params["n_vocab"]]
+                    tpumtjgenerate_stopping_callback.decoded_prompt[i] = utils.decodenewlines(tokenizer.decode(prompt.tolist()))
+                decoded = tpumtjgenerate_stopping_callback.decoded_prompt[i] + utils.decodenewlines(tpumtjgenerate_decode_generated(i, t[seq : seq + n_generated]))
                 #_, found = checkworldinfo(decoded, force_use_txt=True, actions=koboldai_vars.actions)
                 _, _, _, found = koboldai_vars.calc_ai_text(submitted_text=decoded)
                 found -= excluded_world_info[i]
                 if(len(found) != 0):
                     regeneration_required = True
                     break
+            if(regeneration_required):
+                tpumtjgenerate_stopping_callback.decoded_prompt.clear()
+                tpumtjgenerate_stopping_callback.decoded_generated.clear()
             return excluded_world_info, regeneration_required, halt
+        tpumtjgenerate_stopping_callback.decoded_prompt = {}
+        tpumtjgenerate_stopping_callback.decoded_generated = {}
+
+        def tpumtjgenerate_decode_generated(i, tokens) -> str:
+            # Decodes only the newest tokens of sequence i, holding them back
+            # until they form complete characters.  The windows are decoded
+            # without tokenization space cleanup (which depends on the
+            # neighbouring tokens) and the cleanup is applied to the joined
+            # text instead, so the result matches decoding all of the
+            # complete generated tokens at once
+            if(not isinstance(tokenizer, PreTrainedTokenizerBase)):
+                # Raw tokenizers.Tokenizer (NeoX) has neither the cleanup
+                # keyword nor clean_up_tokenization, so decode it all
+                return tokenizer.decode(tokens.tolist())
+            text, prefix_offset, read_offset = tpumtjgenerate_stopping_callback.decoded_generated.get(i, ("", 0, 0))
+            prefix_text = tokenizer.decode(tokens[prefix_offset:read_offset].tolist(), clean_up_tokenization_spaces=False)
+            new_text = tokenizer.decode(tokens[prefix_offset:].tolist(), clean_up_tokenization_spaces=False)
+            if(len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd")):
+                text += new_text[len(prefix_text):]
+                prefix_offset, read_offset = read_offset, len(tokens)
+            tpumtjgenerate_stopping_callback.decoded_generated[i] = (text, prefix_offset, read_offset)
+            return tokenizer.clean_up_tokenization(text)
 
         def tpumtjgenerate_compiling_callback() -> None:
             print(colors.GREEN + "TPU backend compilation triggered" + colors.END)
@@ -3351,7 +3447,7 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
             koboldai_vars.modeldim = int(tpu_mtj_backend.params.get("d_embed", tpu_mtj_backend.params["d_model"]))
             tokenizer = tpu_mtj_backend.tokenizer
             if(koboldai_vars.badwordsids is koboldai_settings.badwordsids_default and koboldai_vars.model_type not in ("gpt2", "gpt_neo", "gptj")):
-                koboldai_vars.badwordsids = [[v] for k, v in tokenizer.get_vocab().items() if any(c in str(k) for c in "<>[]") if koboldai_vars.newlinemode != "s" or str(k) != "</s>"]
+                start_badwordsids_scan(tokenizer, "<>[]", ban_eos=koboldai_vars.newlinemode != "s")
         else:
             loadsettings()
     
@@ -3359,6 +3455,8 @@ def load_model(use_gpu=True, gpu_layers=None, disk_layers=None, initial_load=Fal
     # Load scripts
     load_lua_scripts()
     
+    # final_startup() may already generate (e.g. to compile the TPU backend), so badwordsids has to be ready by now
+    wait_for_badwordsids()
     final_startup()
     #if not initial_load:
     set_aibusy(False)
@@ -5726,7 +5824,7 @@ def raw_generate(
     return result
 
 def tpu_raw_generate(
-    prompt_tokens: List[int],
+    prompt_tokens: np.ndarray,
     max_new: int,
     batch_count: int,
     gen_settings: GenerationSettings
@@ -5735,9 +5833,11 @@ def tpu_raw_generate(
     # Mostly lifted from apiactionsubmit_tpumtjgenerate
     soft_tokens = tpumtjgetsofttokens()
 
+    prompt_tokens = np.asarray(prompt_tokens, dtype=np.uint32)
+
     genout = tpool.execute(
         tpu_mtj_backend.infer_static,
-        np.uint32(prompt_tokens),
+        prompt_tokens,
         gen_len = max_new,
         temp=gen_settings.temp,
         top_p=gen_settings.top_p,
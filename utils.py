@@ -4,6 +4,7 @@ import shutil
 import json
 import subprocess
 import tempfile
+import errno
 from urllib.error import HTTPError
 import requests
 import requests.adapters
@@ -18,7 +19,7 @@ import hashlib
 import huggingface_hub
 import packaging.version
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 HAS_ACCELERATE = packaging.version.parse(transformers_version) >= packaging.version.parse("4.20.0.dev0")
 try:
@@ -32,6 +33,7 @@ num_shards: Optional[int] = None
 current_shard = 0
 from_pretrained_model_name = ""
 from_pretrained_index_filename: Optional[str] = None
+checkpoint_shard_files: Optional[List[str]] = None
 from_pretrained_kwargs = {}
 bar = None
 
@@ -564,6 +566,34 @@ def aria2_hook(pretrained_model_name_or_path: str, force_download=False, cache_d
         with open(os.path.join(_cache_dir, n + ".json"), "w") as f:
             json.dump({"url": u, "etag": t}, f)
 
+#==================================================================#
+#  Downloads all the shards of a sharded huggingface.co checkpoint in
+#  parallel with snapshot_download before from_pretrained runs, since
+#  transformers would otherwise download them one at a time.  Files that
+#  aria2_hook already downloaded are skipped.
+#==================================================================#
+def parallel_download_hook(pretrained_model_name_or_path: str, force_download=False, cache_dir=None, proxies=None, resume_download=False, local_files_only=False, use_auth_token=None, user_agent=None, revision=None, **kwargs):
+    import transformers
+    import transformers.modeling_utils
+    if local_files_only or force_download:
+        return
+    if os.path.isdir(pretrained_model_name_or_path) or os.path.isfile(pretrained_model_name_or_path) or os.path.isfile(pretrained_model_name_or_path + ".index") or transformers.modeling_utils.is_remote_url(pretrained_model_name_or_path):
+        return
+    if packaging.version.parse(transformers.__version__) < packaging.version.parse("4.22.0.dev0"):  # snapshot_download only writes the new cache layout
+        return
+    if isinstance(huggingface_hub.try_to_load_from_cache(pretrained_model_name_or_path, transformers.modeling_utils.WEIGHTS_NAME, cache_dir=cache_dir, revision=revision), str):
+        return
+    try:
+        index_filename = huggingface_hub.hf_hub_download(pretrained_model_name_or_path, transformers.modeling_utils.WEIGHTS_INDEX_NAME, cache_dir=cache_dir, proxies=proxies, resume_download=resume_download, use_auth_token=use_auth_token, user_agent=user_agent, revision=revision)
+    except Exception:  # Not a sharded checkpoint (or not reachable), so leave it to from_pretrained
+        return
+    with open(index_filename) as f:
+        map_data = json.load(f)
+    filenames = sorted(set(map_data["weight_map"].values()))
+    if all(isinstance(huggingface_hub.try_to_load_from_cache(pretrained_model_name_or_path, n, cache_dir=cache_dir, revision=revision), str) for n in filenames):
+        return
+    huggingface_hub.snapshot_download(pretrained_model_name_or_path, revision=revision, cache_dir=cache_dir, user_agent=user_agent, proxies=proxies, resume_download=resume_download, use_auth_token=use_auth_token, allow_patterns=filenames, max_workers=8)
+
 #==================================================================#
 #  Given the path to a pytorch_model.bin.index.json, returns how many
 #  shards there are in the model
@@ -585,6 +615,95 @@ def get_sharded_checkpoint_num_tensors(pretrained_model_name_or_path, filename,
     shard_paths, _ = transformers.modeling_utils.get_checkpoint_shard_files(pretrained_model_name_or_path, filename, cache_dir=cache_dir, force_download=force_download, proxies=proxies, resume_download=resume_download, local_files_only=local_files_only, use_auth_token=use_auth_token, user_agent=user_agent, revision=_revision)
     return list(itertools.chain(*(torch.load(p, map_location="cpu").keys() for p in shard_paths)))
 
+#==================================================================#
+#  Given the name of a Hugging Face Hub model and a list of filenames that
+#  have already been downloaded into cache_dir, returns the local paths of
+#  those files without sending any requests to the Hub
+#==================================================================#
+def get_cached_file_paths(pretrained_model_name_or_path, filenames, cache_dir=None, revision=None, legacy_cache_layout=False) -> List[str]:
+    if legacy_cache_layout:
+        return [huggingface_hub.hf_hub_download(pretrained_model_name_or_path, n, revision=revision, cache_dir=cache_dir, local_files_only=True, legacy_cache_layout=True) for n in filenames]
+    paths = [huggingface_hub.try_to_load_from_cache(pretrained_model_name_or_path, n, cache_dir=cache_dir, revision=revision) for n in filenames]
+    for n, p in zip(filenames, paths):
+        if not isinstance(p, str):
+            raise FileNotFoundError(f"{n} of {pretrained_model_name_or_path} is not in the cache")
+    return paths
+
+#==================================================================#
+#  Returns whether any of the given checkpoint files stores a float32
+#  tensor with at least two dimensions.  Only the JSON header of
+#  .safetensors files and the pickled metadata of pytorch_model.bin files
+#  are read, never the tensor data itself
+#==================================================================#
+def checkpoint_has_fp32_tensors(filenames) -> bool:
+    import struct
+    import torch
+    import torch_lazy_loader
+    for filename in filenames:
+        if filename.endswith(".safetensors"):
+            with open(filename, "rb") as f:
+                header_size, = struct.unpack("<Q", f.read(8))
+                header = json.loads(f.read(header_size))
+            if any(k != "__metadata__" and v["dtype"] == "F32" and len(v["shape"]) >= 2 for k, v in header.items()):
+                return True
+        else:
+            with torch_lazy_loader.use_lazy_torch_load():
+                state_dict = torch.load(filename, map_location="cpu")
+            if any(t.dtype is torch.float32 and len(t.shape) >= 2 for t in state_dict.values()):
+                return True
+    return False
+
+#==================================================================#
+#  Moves a file, using a plain rename when the source and destination
+#  are on the same filesystem and falling back to a copy otherwise
+#==================================================================#
+def move_file(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+#==================================================================#
+#  Moves each (src, dst) pair with move_file, several at a time
+#==================================================================#
+def move_files(pairs, max_workers=8):
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda p: move_file(*p), pairs))
+
+#==================================================================#
+#  Asks the OS to start reading the checkpoint shard after the given one
+#  into the page cache, so that reading it from disk overlaps with
+#  deserializing the current shard.  Only one shard is hinted at a time,
+#  and only if it fits in the available RAM, so that on hosts with less
+#  RAM than the model the hint can't evict shards before they are read.
+#  Does nothing on platforms without posix_fadvise (e.g. Windows)
+#==================================================================#
+def prefetch_next_checkpoint_shard(shard_file):
+    import psutil
+    if not hasattr(os, "posix_fadvise") or not checkpoint_shard_files:
+        return
+    try:
+        i = checkpoint_shard_files.index(shard_file)
+    except ValueError:
+        return
+    if i + 1 >= len(checkpoint_shard_files):
+        return
+    try:
+        if os.path.getsize(checkpoint_shard_files[i + 1]) > psutil.virtual_memory().available:
+            return
+        fd = os.open(checkpoint_shard_files[i + 1], os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
 #==================================================================#
 #  Given a PreTrainedModel, returns the list of module names that correspond
 #  to the model's hidden layers.
@@ -601,6 +720,33 @@ def get_layers_module_names(model: PreTrainedModel) -> List[str]:
     recurse(model)
     return names
 
+#==================================================================#
+#  Given a PreTrainedModel, returns the keys its state_dict() would have
+#  and the list of its named buffers, in one walk over the module tree
+#  and without building the state_dict itself.
+#==================================================================#
+def get_state_dict_names_and_buffers(model: PreTrainedModel) -> Tuple[List[str], List[tuple]]:
+    names: List[str] = []
+    buffers: List[tuple] = []
+    seen_buffers = set()
+    def recurse(module, head=""):
+        for n, p in module._parameters.items():
+            if p is not None:
+                names.append(head + n)
+        for n, b in module._buffers.items():
+            if b is None:
+                continue
+            if n not in module._non_persistent_buffers_set:
+                names.append(head + n)
+            if id(b) not in seen_buffers:
+                seen_buffers.add(id(b))
+                buffers.append((head + n, b))
+        for n, c in module._modules.items():
+            if c is not None:
+                recurse(c, head=head + n + ".")
+    recurse(model)
+    return names, buffers
+
 #==================================================================#
 #  Given a PreTrainedModel, returns the module name that corresponds
 #  to the model's input embeddings.